@@ -3,9 +3,12 @@
 import sqlalchemy
 import os
 import datetime
+import dataclasses
+import collections
+import concurrent.futures
+import operator
 import zipfile
-import io
-import json
+import orjson
 
 ################################################################################
 # helper functions
@@ -21,340 +24,663 @@ def remove_nulls(s):
     >>> remove_nulls('hello\x00 world')
     'hello world'
     '''
+    if s is None or '\x00' not in s:
+        return s
+    else:
+        return s.replace('\x00','')
+
+
+MONTHS = {
+    month: i
+    for i, month in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)
+    }
+
+
+def parse_created_at(s):
+    '''
+    Convert one of twitter's created_at strings into a timezone-aware datetime.
+    The binary COPY format sends timestamps as numbers,
+    so they can no longer be passed through as text for postgres to parse.
+
+    twitter always uses the same fixed-width format,
+    so the fields are sliced out directly rather than with strptime, which is several times slower.
+
+    >>> parse_created_at('Fri Jan 01 00:00:00 +0000 2021')
+    datetime.datetime(2021, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)
+    >>> parse_created_at('Wed Oct 10 20:19:24 -0130 2018')
+    datetime.datetime(2018, 10, 10, 20, 19, 24, tzinfo=datetime.timezone(datetime.timedelta(days=-1, seconds=81000)))
+    >>> parse_created_at(None)
+    '''
     if s is None:
         return None
+    if s[20:25] == '+0000':
+        tz = datetime.timezone.utc
     else:
-        return s.replace('\x00','')
+        offset = datetime.timedelta(hours=int(s[21:23]), minutes=int(s[23:25]))
+        tz = datetime.timezone(-offset if s[20] == '-' else offset)
+    return datetime.datetime(
+        int(s[26:30]),
+        MONTHS[s[4:7]],
+        int(s[8:10]),
+        int(s[11:13]),
+        int(s[14:16]),
+        int(s[17:19]),
+        tzinfo=tz,
+        )
 
 
-def get_id_urls(url, connection):
+# NOTE:
+# a few urls (profile links, popular media) appear in a large fraction of tweets;
+# get_id_urls_bulk remembers the ids it has already looked up so that each url is sent to the database only once per process;
+# the oldest entries are evicted once there are more than URL_CACHE_SIZE of them
+URL_CACHE_SIZE = 1_000_000
+_url_cache = collections.OrderedDict()
+
+# NOTE:
+# the statements are constructed once at import time rather than on every call;
+# they are run directly on a psycopg cursor with prepare=True (see flush_batch),
+# so postgres plans each of them once per connection instead of once per batch
+INSERT_URLS_SQL = '''
+INSERT INTO urls
+    (url)
+    SELECT unnest(CAST(%(urls)s AS TEXT[]))
+ON CONFLICT DO NOTHING
+RETURNING id_urls, url
+'''
+
+SELECT_URLS_SQL = '''
+SELECT id_urls, url
+FROM urls
+WHERE url = ANY(%(urls)s)
+'''
+
+
+def get_id_urls_bulk(urls, cursor):
     '''
-    Given a url, return the corresponding id in the urls table.
-    If no row exists for the url, then one is inserted automatically.
+    Given an iterable of urls, return a dictionary mapping each url to its id in the urls table.
+    Urls that have no row are inserted automatically.
+    All of the urls that are not already cached are resolved with at most two round trips.
     '''
-    sql = sqlalchemy.sql.text('''
-    INSERT INTO urls
-        (url)
-        VALUES
-        (:url)
-    ON CONFLICT DO NOTHING
-    RETURNING id_urls
-    ''')
-    res = connection.execute(sql, {'url': url}).first()
-
-    # If no row was returned, we had a conflict, so we must SELECT the existing row
-    if res is None:
-        sql = sqlalchemy.sql.text('''
-        SELECT id_urls
-        FROM urls
-        WHERE url = :url
-        ''')
-        res = connection.execute(sql, {'url': url}).first()
-
-    return res[0]
-
-
-def insert_tweet(connection, tweet):
+    ids = {}
+    missing = []
+    for url in set(urls):
+        id_urls = _url_cache.get(url)
+        if id_urls is None:
+            missing.append(url)
+        else:
+            _url_cache.move_to_end(url)
+            ids[url] = id_urls
+
+    # NOTE:
+    # the urls are sorted so that concurrent processes insert them in the same order and cannot deadlock;
+    # ON CONFLICT DO UPDATE would also return the existing urls in one statement,
+    # but it locks their rows until the end of the transaction,
+    # and those locks deadlock with the foreign key checks of other processes on users/tweet_urls/tweet_media
+    if missing:
+        missing.sort()
+        res = cursor.execute(INSERT_URLS_SQL, {'urls': missing}, prepare=True).fetchall()
+
+        # If fewer rows were returned than urls, we had conflicts, so we must SELECT the existing rows
+        if len(res) < len(missing):
+            res = cursor.execute(SELECT_URLS_SQL, {'urls': missing}, prepare=True).fetchall()
+
+        for id_urls, url in res:
+            ids[url] = id_urls
+            _url_cache[url] = id_urls
+        while len(_url_cache) > URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
+
+    return ids
+
+
+################################################################################
+# staging tables
+################################################################################
+
+# NOTE:
+# insert_tweet does not INSERT anything itself;
+# it appends one tuple per row to the Batch list for the row's table.
+# Every batch_size tweets, flush_batch streams each list into a staging table with COPY,
+# and then moves the staged rows into the real table with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+# This replaces ~10 round trips per tweet with ~2 round trips per table per batch.
+#
+# The staging tables are TEMPORARY rather than UNLOGGED.
+# Temporary tables also skip the WAL,
+# but they are private to each session,
+# so the load_tweets.py processes that load_tweets_parallel.sh runs concurrently cannot truncate each other's rows.
+#
+# The tables are listed in foreign key order; users must be flushed before tweets, and tweets before the rest.
+# Each column is mapped to the type it has in the staging table.
+# These are the types of the real columns, except that the geo column is staged as WKT text;
+# postgis's implicit text->geometry cast converts it when the rows are moved into tweets.
+# insert_tweet stores the url itself in the id_urls column;
+# flush_batch replaces the urls with their ids just before the COPY.
+STAGING_COLUMNS = {
+    'users': {
+        'id_users': 'int8',
+        'created_at': 'timestamptz',
+        'updated_at': 'timestamptz',
+        'screen_name': 'text',
+        'name': 'text',
+        'location': 'text',
+        'id_urls': 'int8',
+        'description': 'text',
+        'protected': 'bool',
+        'verified': 'bool',
+        'friends_count': 'int4',
+        'listed_count': 'int4',
+        'favourites_count': 'int4',
+        'statuses_count': 'int4',
+        'withheld_in_countries': 'varchar[]',
+        },
+    'tweets': {
+        'id_tweets': 'int8',
+        'id_users': 'int8',
+        'created_at': 'timestamptz',
+        'in_reply_to_status_id': 'int8',
+        'in_reply_to_user_id': 'int8',
+        'quoted_status_id': 'int8',
+        'retweet_count': 'int2',
+        'favorite_count': 'int2',
+        'quote_count': 'int2',
+        'withheld_copyright': 'bool',
+        'withheld_in_countries': 'varchar[]',
+        'source': 'text',
+        'text': 'text',
+        'country_code': 'varchar',
+        'state_code': 'varchar',
+        'lang': 'text',
+        'place_name': 'text',
+        'geo': 'text',
+        },
+    'tweet_urls': {'id_tweets': 'int8', 'id_urls': 'int8'},
+    'tweet_mentions': {'id_tweets': 'int8', 'id_users': 'int8'},
+    'tweet_tags': {'id_tweets': 'int8', 'tag': 'text'},
+    'tweet_media': {'id_tweets': 'int8', 'id_urls': 'int8', 'type': 'text'},
+    }
+
+
+# NOTE:
+# these settings are applied to every session that load_tweets.py opens;
+# with synchronous_commit off, a commit returns without waiting for its WAL to be flushed to disk,
+# so a crash can lose the last few batches, but not corrupt the database;
+# that is acceptable because reloading a file is idempotent (ON CONFLICT DO NOTHING);
+# work_mem is used by the sorts and hashes of the upserts,
+# and maintenance_work_mem by the CREATE INDEX statements of --drop_indexes
+SESSION_SETTINGS = {
+    'synchronous_commit': 'off',
+    'work_mem': '256MB',
+    'maintenance_work_mem': '1GB',
+    }
+
+
+def create_engine(db, application_name='load_tweets.py'):
     '''
-    Insert the tweet into the database (normalized schema).
+    Create an engine with a single connection to the database at the url db.
+
+    COPY requires the psycopg (version 3) driver,
+    so it is used regardless of the driver named in the url.
+    The SESSION_SETTINGS are sent as startup options, so they cost no extra round trips.
     '''
+    db_url = sqlalchemy.engine.make_url(db).set(drivername='postgresql+psycopg')
+    return sqlalchemy.create_engine(db_url, pool_size=1, connect_args={
+        'application_name': application_name,
+        'options': ' '.join(f'-c {name}={value}' for name, value in SESSION_SETTINGS.items()),
+    })
+
 
-    # Wrap all inserts in a single transaction so that
-    # a tweet is either fully inserted or not at all.
-    with connection.begin() as trans:
-
-        #################################################
-        # 1. Skip if this tweet is already inserted
-        #################################################
-        sql = sqlalchemy.sql.text('''
-        SELECT id_tweets
-        FROM tweets
-        WHERE id_tweets = :id_tweets
-        ''')
-        res = connection.execute(sql, {'id_tweets': str(tweet['id'])}).first()
-        if res is not None:
-            # tweet is already in the DB; nothing else to do
-            return
-
-        #################################################
-        # 2. Insert user
-        #################################################
-        if tweet['user']['url'] is None:
-            user_id_urls = None
+def create_staging_tables(connection):
+    '''
+    Create a staging_<table> temporary table for every table in STAGING_COLUMNS.
+    The rows are deleted automatically whenever the transaction that flushed them commits.
+    '''
+    for table, columns in STAGING_COLUMNS.items():
+        connection.execute(sqlalchemy.sql.text(f'''
+        CREATE TEMPORARY TABLE staging_{table} ({",".join(f"{column} {type}" for column, type in columns.items())})
+        ON COMMIT DELETE ROWS
+        '''))
+    connection.commit()
+
+
+# NOTE:
+# updating the secondary indexes (gist, gin, and plain btree) row by row is a large part of the cost of a bulk load;
+# building them once after the load is much cheaper;
+# the PRIMARY KEY and UNIQUE indexes are never dropped because ON CONFLICT needs them
+SECONDARY_INDEXES_SQL = sqlalchemy.sql.text('''
+SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+FROM pg_index
+WHERE indrelid = ANY(CAST(:tables AS REGCLASS[]))
+  AND NOT indisprimary
+  AND NOT indisunique
+ORDER BY 1
+''')
+
+
+def drop_indexes(connection):
+    '''
+    Drop the secondary indexes of the tables in STAGING_COLUMNS.
+    Returns the CREATE INDEX statements that rebuild them.
+
+    The statements are also printed before anything is dropped,
+    so that the indexes can be rebuilt by hand if the process is killed before create_indexes runs.
+    '''
+    indexes = connection.execute(SECONDARY_INDEXES_SQL, {'tables': list(STAGING_COLUMNS)}).all()
+    for name, definition in indexes:
+        print(datetime.datetime.now(), 'saved index', definition)
+    for name, definition in indexes:
+        print(datetime.datetime.now(), 'dropping index', name)
+        connection.execute(sqlalchemy.sql.text(f'DROP INDEX {name}'))
+    return [definition for name, definition in indexes]
+
+
+def create_indexes(connection, definitions):
+    '''
+    Run the CREATE INDEX statements returned by drop_indexes.
+    '''
+    for definition in definitions:
+        print(datetime.datetime.now(), definition)
+        connection.execute(sqlalchemy.sql.text(definition))
+
+
+# like the url statements, the SQL for flushing each table is generated once, rather than once per batch
+#
+# NOTE:
+# the binary COPY format sends ints and timestamps in their on-disk form,
+# so the server does not have to parse them out of text
+COPY_SQL = {
+    table: f'COPY staging_{table} ({",".join(columns)}) FROM STDIN (FORMAT BINARY)'
+    for table, columns in STAGING_COLUMNS.items()
+    }
+
+def _upsert_sql(table):
+    '''
+    Generate the SQL that moves the rows of staging_<table> into <table>.
+
+    The tweets statement returns the ids of the tweets that were not already in the database,
+    and the statements for the tables that link to tweets only keep the rows of those tweets.
+    So if a tweet has already been loaded, none of its rows are inserted again.
+
+    >>> _upsert_sql('tweet_tags')
+    'INSERT INTO tweet_tags (id_tweets,tag) SELECT id_tweets,tag FROM staging_tweet_tags WHERE id_tweets = ANY(%(id_tweets)s) ON CONFLICT DO NOTHING'
+    >>> _upsert_sql('tweets').endswith('ON CONFLICT DO NOTHING RETURNING id_tweets')
+    True
+    '''
+    columns = ','.join(STAGING_COLUMNS[table])
+    sql = f'INSERT INTO {table} ({columns}) SELECT {columns} FROM staging_{table}'
+    if table not in ('users', 'tweets'):
+        sql += ' WHERE id_tweets = ANY(%(id_tweets)s)'
+    sql += ' ON CONFLICT DO NOTHING'
+    if table == 'tweets':
+        sql += ' RETURNING id_tweets'
+    return sql
+
+
+UPSERT_SQL = {
+    table: _upsert_sql(table)
+    for table in STAGING_COLUMNS
+    }
+
+# the position of the id_urls column in the rows of each table that has one;
+# flush_batch replaces the urls in these columns with their ids
+URL_COLUMNS = {
+    table: list(columns).index('id_urls')
+    for table, columns in STAGING_COLUMNS.items()
+    if 'id_urls' in columns
+    }
+
+
+@dataclasses.dataclass
+class Batch:
+    '''
+    The rows buffered for each table in STAGING_COLUMNS.
+    Each row is a tuple whose entries are in the same order as the table's STAGING_COLUMNS entry.
+
+    NOTE:
+    The same users, urls, mentions, and tags recur many times within a batch.
+    The rows are deduplicated here rather than sent to postgres for ON CONFLICT to discard.
+    users and tweets are dictionaries keyed by id, so that the first row for each id is kept (as ON CONFLICT would);
+    the tables that link to tweets are sets, because their rows are the whole key.
+
+    >>> batch = Batch()
+    >>> batch.users.setdefault(1, (1, 'first'))
+    (1, 'first')
+    >>> batch.users.setdefault(1, (1, 'second'))
+    (1, 'first')
+    >>> batch.tweet_tags.add((1, '#coronavirus'))
+    >>> batch.tweet_tags.add((1, '#coronavirus'))
+    >>> batch.rows('tweet_tags')
+    [(1, '#coronavirus')]
+    >>> batch.rows('users')
+    [(1, 'first')]
+    >>> Batch().rows('tweets')
+    []
+    '''
+    users: dict = dataclasses.field(default_factory=dict)
+    tweets: dict = dataclasses.field(default_factory=dict)
+    tweet_urls: set = dataclasses.field(default_factory=set)
+    tweet_mentions: set = dataclasses.field(default_factory=set)
+    tweet_tags: set = dataclasses.field(default_factory=set)
+    tweet_media: set = dataclasses.field(default_factory=set)
+
+    def rows(self, table):
+        '''
+        Return a list of the rows buffered for the table.
+        '''
+        rows = getattr(self, table)
+        if isinstance(rows, dict):
+            return list(rows.values())
         else:
-            user_id_urls = get_id_urls(tweet['user']['url'], connection)
-
-        sql = sqlalchemy.sql.text('''
-        INSERT INTO users (
-            id_users,
-            created_at,
-            updated_at,
-            screen_name,
-            name,
-            location,
-            id_urls,
-            description,
-            protected,
-            verified,
-            friends_count,
-            listed_count,
-            favourites_count,
-            statuses_count,
-            withheld_in_countries
-        )
-        VALUES (
-            :id_users,
-            :created_at,
-            :updated_at,
-            :screen_name,
-            :name,
-            :location,
-            :id_urls,
-            :description,
-            :protected,
-            :verified,
-            :friends_count,
-            :listed_count,
-            :favourites_count,
-            :statuses_count,
-            :withheld_in_countries
-        )
-        ON CONFLICT (id_users) DO NOTHING
-        ''')
-        connection.execute(sql, {
-            'id_users':           str(tweet['user']['id']),
-            'created_at':         tweet.get('created_at'),
-            'updated_at':         tweet.get('updated_at'),
-            'screen_name':        tweet.get('screen_name'),
-            'name':               tweet.get('name'),
-            'location':           tweet.get('location'),
-            'id_urls':            user_id_urls,
-            'description':        tweet.get('description'),
-            'protected':          tweet.get('protected'),
-            'verified':           tweet.get('verified'),
-            'friends_count':      tweet.get('friends_count'),
-            'listed_count':       tweet.get('listed_count'),
-            'favourites_count':   tweet.get('favourites_count'),
-            'statuses_count':     tweet.get('statuses_count'),
-            'withheld_in_countries': tweet.get('withheld_in_countries'),
-        })
-
-        #################################################
-        # 3. Prepare tweet‐level fields
-        #################################################
-        try:
-            geo_coords = tweet['geo']['coordinates']
-            geo_str = 'POINT'
-        except TypeError:
-            try:
-                geo_coords = '('
-                for i, poly in enumerate(tweet['place']['bounding_box']['coordinates']):
-                    if i > 0:
-                        geo_coords += ','
-                    geo_coords += '('
-                    for j, point in enumerate(poly):
-                        geo_coords += f"{point[0]} {point[1]},"
-                    # close the ring
-                    geo_coords += f"{poly[0][0]} {poly[0][1]})"
-                geo_coords += ')'
-                geo_str = 'MULTIPOLYGON'
-            except KeyError:
-                # user might have geo_enabled, but no place data
-                if tweet['user']['geo_enabled']:
-                    geo_str = None
-                    geo_coords = None
+            return list(rows)
+
+
+# the null columns of an unhydrated user are the same for every user, so the tuple is built only once
+_UNHYDRATED_USER_NULLS = (None,) * (len(STAGING_COLUMNS['users']) - 1)
 
-        try:
-            text = tweet['extended_tweet']['full_text']
-        except KeyError:
-            text = tweet['text']
 
+def unhydrated_user(id_users):
+    '''
+    Return a users row that contains only the id.
+
+    >>> len(unhydrated_user(5)) == len(STAGING_COLUMNS['users'])
+    True
+    '''
+    return (id_users,) + _UNHYDRATED_USER_NULLS
+
+
+def flush_batch(connection, batch):
+    '''
+    Load all of the rows in the batch into the database in a single transaction.
+    '''
+    rows = {table: batch.rows(table) for table in STAGING_COLUMNS}
+
+    # every statement that touches the database runs inside this one transaction;
+    # connection.connection is the raw psycopg connection,
+    # which is used directly because SQLAlchemy has no interface for COPY,
+    # and because its per-statement overhead buys nothing for these fixed statements
+    with connection.begin(), connection.connection.cursor() as cursor:
+
+        # resolve every url in the batch with one round trip
+        urls = {
+            row[i]
+            for table, i in URL_COLUMNS.items()
+            for row in rows[table]
+            if row[i] is not None
+            }
+        id_urls = get_id_urls_bulk(urls, cursor)
+        for table, i in URL_COLUMNS.items():
+            rows[table] = [row[:i] + (id_urls.get(row[i]),) + row[i+1:] for row in rows[table]]
+
+        # NOTE:
+        # other load_tweets.py processes may be inserting the same users and tweets at the same time;
+        # inserting the keys in ascending order in every process prevents them from deadlocking
+        rows['users'].sort(key=operator.itemgetter(0))
+        rows['tweets'].sort(key=operator.itemgetter(0))
+
+        for table in STAGING_COLUMNS:
+            if rows[table]:
+                with cursor.copy(COPY_SQL[table]) as copy:
+                    copy.set_types(list(STAGING_COLUMNS[table].values()))
+                    for row in rows[table]:
+                        copy.write_row(row)
+
+        new_id_tweets = []
+        for table in STAGING_COLUMNS:
+            if rows[table]:
+                cursor.execute(UPSERT_SQL[table], {'id_tweets': new_id_tweets}, prepare=True)
+                if table == 'tweets':
+                    new_id_tweets = [id_tweets for id_tweets, in cursor.fetchall()]
+
+
+################################################################################
+# main functions
+################################################################################
+
+def insert_tweet(tweet, batch):
+    r'''
+    Append the rows for the tweet (normalized schema) to the batch.
+    The rows are not visible in the database until flush_batch is called.
+
+    This function does not touch the database;
+    it is the pure json-to-rows step of the loader,
+    and so it can be profiled and tested on its own.
+
+    >>> tweet = {
+    ...     'id': 2,
+    ...     'created_at': 'Fri Jan 01 00:00:00 +0000 2021',
+    ...     'text': 'hello #world',
+    ...     'source': 'web\x00',
+    ...     'user': {'id': 1, 'url': 'https://example.com/user', 'geo_enabled': True},
+    ...     'geo': None,
+    ...     'place': {
+    ...         'full_name': 'Euless, TX',
+    ...         'country_code': 'US',
+    ...         'bounding_box': {'coordinates': [[[0, 1], [2, 3]]]},
+    ...         },
+    ...     'in_reply_to_user_id': 3,
+    ...     'entities': {
+    ...         'urls': [{'expanded_url': 'https://example.com'}],
+    ...         'user_mentions': [{'id': 4, 'name': 'n', 'screen_name': 's'}],
+    ...         'hashtags': [{'text': 'world'}],
+    ...         'symbols': [{'text': 'ABC'}],
+    ...         },
+    ...     'extended_entities': {'media': [{'media_url': 'https://example.com/a.jpg', 'type': 'photo'}]},
+    ...     }
+    >>> batch = Batch()
+    >>> insert_tweet(tweet, batch)
+    >>> [(row[0], row[6]) for row in batch.rows('users')]
+    [(1, 'https://example.com/user'), (3, None), (4, None)]
+    >>> batch.tweets[2][:5]
+    (2, 1, datetime.datetime(2021, 1, 1, 0, 0, tzinfo=datetime.timezone.utc), None, 3)
+    >>> batch.tweets[2][11:]
+    ('web', 'hello #world', 'us', 'tx', None, 'Euless, TX', 'MULTIPOLYGON(((0 1,2 3,0 1)))')
+    >>> batch.tweet_urls
+    {(2, 'https://example.com')}
+    >>> batch.tweet_mentions
+    {(2, 4)}
+    >>> sorted(batch.tweet_tags)
+    [(2, '#world'), (2, '$ABC')]
+    >>> batch.tweet_media
+    {(2, 'https://example.com/a.jpg', 'photo')}
+    '''
+
+    # NOTE:
+    # the fields that are used more than once are looked up once and bound to locals;
+    # the entities of extended tweets (which have more than 140 characters) are inside extended_tweet,
+    # so the entities dictionary is chosen once here rather than with a try/except in every section below
+    id_tweets = tweet['id']
+    user = tweet['user']
+    in_reply_to_user_id = tweet.get('in_reply_to_user_id')
+    extended_tweet = tweet.get('extended_tweet')
+    entities = (extended_tweet or tweet)['entities']
+
+    # the same timestamp is used by both the users and tweets rows, so it is parsed only once
+    created_at = parse_created_at(tweet.get('created_at'))
+
+    #################################################
+    # 1. Insert user
+    #################################################
+    batch.users.setdefault(user['id'], (
+        user['id'],
+        created_at,
+        parse_created_at(tweet.get('updated_at')),
+        tweet.get('screen_name'),
+        tweet.get('name'),
+        tweet.get('location'),
+        user['url'],
+        tweet.get('description'),
+        tweet.get('protected'),
+        tweet.get('verified'),
+        tweet.get('friends_count'),
+        tweet.get('listed_count'),
+        tweet.get('favourites_count'),
+        tweet.get('statuses_count'),
+        tweet.get('withheld_in_countries'),
+        ))
+
+    #################################################
+    # 2. Prepare tweet‐level fields
+    #################################################
+    # NOTE:
+    # the geo column is sent as WKT text, which postgis parses on the way in;
+    # the rings are built with str.join because repeated += copies the string on every append
+    try:
+        geo_coords = tweet['geo']['coordinates']
+        geo = f'POINT({geo_coords[0]} {geo_coords[1]})'
+    except TypeError:
         try:
-            country_code = tweet['place']['country_code'].lower()
+            rings = [
+                '(' + ','.join(f'{point[0]} {point[1]}' for point in poly + poly[:1]) + ')'
+                for poly in tweet['place']['bounding_box']['coordinates']
+                ]
+            geo = 'MULTIPOLYGON((' + ','.join(rings) + '))'
         except (TypeError, KeyError):
-            country_code = None
+            # user might have geo_enabled, but no place data
+            geo = None
 
-        if country_code == 'us':
-            state_code = tweet['place']['full_name'].split(',')[-1].strip().lower()
-            if len(state_code) > 2:
-                state_code = None
-        else:
+    if extended_tweet is not None:
+        text = extended_tweet['full_text']
+    else:
+        text = tweet['text']
+
+    try:
+        country_code = tweet['place']['country_code'].lower()
+    except (TypeError, KeyError):
+        country_code = None
+
+    if country_code == 'us':
+        state_code = tweet['place']['full_name'].split(',')[-1].strip().lower()
+        if len(state_code) > 2:
             state_code = None
+    else:
+        state_code = None
+
+    try:
+        place_name = tweet['place']['full_name']
+    except (TypeError, KeyError):
+        place_name = None
+
+    # Ensure the in_reply_to user is in the DB (unhydrated)
+    #
+    # NOTE:
+    # the unhydrated users go into the same buffer as the hydrated ones,
+    # so they are loaded by the batch's single users COPY;
+    # the same replied-to and mentioned users recur many times within a batch,
+    # so the membership test avoids building a row that setdefault would throw away
+    if in_reply_to_user_id is not None and in_reply_to_user_id not in batch.users:
+        batch.users[in_reply_to_user_id] = unhydrated_user(in_reply_to_user_id)
+
+    #################################################
+    # 3. Insert into tweets table
+    #################################################
+    # NOTE:
+    # only the free-text fields can contain null characters;
+    # the country, state and language codes are short fixed vocabularies, so they skip remove_nulls
+    batch.tweets.setdefault(id_tweets, (
+        id_tweets,
+        user['id'],
+        created_at,
+        tweet.get('in_reply_to_status_id'),
+        in_reply_to_user_id,
+        tweet.get('quoted_status_id'),
+        tweet.get('retweet_count'),
+        tweet.get('favorite_count'),
+        tweet.get('quote_count'),
+        tweet.get('withheld_copyright'),
+        tweet.get('withheld_in_countries'),
+        remove_nulls(tweet.get('source')),
+        remove_nulls(text),
+        country_code,
+        state_code,
+        tweet.get('lang'),
+        remove_nulls(place_name),
+        geo,
+        ))
+
+    #################################################
+    # 4. tweet_urls
+    #################################################
+    for u in entities['urls']:
+        batch.tweet_urls.add((id_tweets, u['expanded_url']))
+
+    #################################################
+    # 5. tweet_mentions
+    #################################################
+    for mention in entities['user_mentions']:
+        # unhydrated user insert
+        if mention['id'] not in batch.users:
+            batch.users[mention['id']] = unhydrated_user(mention['id'])
+
+        # insert mention link
+        batch.tweet_mentions.add((id_tweets, mention['id']))
+
+    #################################################
+    # 6. tweet_tags
+    #################################################
+    tags = ['#' + h['text'] for h in entities['hashtags']] + ['$' + c['text'] for c in entities['symbols']]
+    for tag in tags:
+        batch.tweet_tags.add((id_tweets, remove_nulls(tag)))
+
+    #################################################
+    # 7. tweet_media
+    #################################################
+    extended_entities = (extended_tweet or {}).get('extended_entities') or tweet.get('extended_entities') or {}
+    for m in extended_entities.get('media', []):
+        batch.tweet_media.add((id_tweets, m['media_url'], m['type']))
+
+
+def ingest_file(filename, db, batch_size=10000, print_every=1000):
+    '''
+    Load every tweet in the zip file into the database at the url db.
 
-        try:
-            place_name = tweet['place']['full_name']
-        except (TypeError, KeyError):
-            place_name = None
-
-        # Ensure the in_reply_to user is in the DB (unhydrated)
-        if tweet.get('in_reply_to_user_id') is not None:
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO users (id_users)
-            VALUES (:id_users)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {'id_users': str(tweet['in_reply_to_user_id'])})
-
-        #################################################
-        # 4. Insert into tweets table
-        #################################################
-        sql = sqlalchemy.sql.text('''
-        INSERT INTO tweets (
-            id_tweets,
-            id_users,
-            created_at,
-            in_reply_to_status_id,
-            in_reply_to_user_id,
-            quoted_status_id,
-            retweet_count,
-            favorite_count,
-            quote_count,
-            withheld_copyright,
-            withheld_in_countries,
-            source,
-            text,
-            country_code,
-            state_code,
-            lang,
-            place_name,
-            geo
-        )
-        VALUES (
-            :id_tweets,
-            :id_users,
-            :created_at,
-            :in_reply_to_status_id,
-            :in_reply_to_user_id,
-            :quoted_status_id,
-            :retweet_count,
-            :favorite_count,
-            :quote_count,
-            :withheld_copyright,
-            :withheld_in_countries,
-            :source,
-            :text,
-            :country_code,
-            :state_code,
-            :lang,
-            :place_name,
-            :geo
-        )
-        ON CONFLICT DO NOTHING
-        ''')
-        connection.execute(sql, {
-            'id_tweets':            str(tweet['id']),
-            'id_users':             str(tweet['user']['id']),
-            'created_at':           tweet.get('created_at'),
-            'in_reply_to_status_id': tweet.get('in_reply_to_status_id'),
-            'in_reply_to_user_id':   str(tweet.get('in_reply_to_user_id')) if tweet.get('in_reply_to_user_id') else None,
-            'quoted_status_id':      tweet.get('quoted_status_id'),
-            'retweet_count':         tweet.get('retweet_count'),
-            'favorite_count':        tweet.get('favorite_count'),
-            'quote_count':           tweet.get('quote_count'),
-            'withheld_copyright':    tweet.get('withheld_copyright'),
-            'withheld_in_countries': tweet.get('withheld_in_countries'),
-            'source':                remove_nulls(tweet.get('source')),
-            'text':                  remove_nulls(text),
-            'country_code':          remove_nulls(country_code),
-            'state_code':            remove_nulls(state_code),
-            'lang':                  remove_nulls(tweet.get('lang')),
-            'place_name':            remove_nulls(place_name),
-            'geo':                   None
-        })
-
-        #################################################
-        # 5. tweet_urls
-        #################################################
-        try:
-            urls = tweet['extended_tweet']['entities']['urls']
-        except KeyError:
-            urls = tweet['entities']['urls']
-
-        for u in urls:
-            id_urls = get_id_urls(u['expanded_url'], connection)
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO tweet_urls (id_tweets, id_urls)
-            VALUES (:id_tweets, :id_urls)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {
-                'id_tweets': tweet['id'],
-                'id_urls':   id_urls
-            })
-
-        #################################################
-        # 6. tweet_mentions
-        #################################################
-        try:
-            mentions = tweet['extended_tweet']['entities']['user_mentions']
-        except KeyError:
-            mentions = tweet['entities']['user_mentions']
-
-        for mention in mentions:
-            # unhydrated user insert
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO users (id_users)
-            VALUES (:id_users)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {'id_users': mention['id']})
-
-            # insert mention link
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO tweet_mentions (id_tweets, id_users)
-            VALUES (:id_tweets, :id_users)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {
-                'id_tweets': tweet['id'],
-                'id_users':  mention['id']
-            })
-
-        #################################################
-        # 7. tweet_tags
-        #################################################
-        try:
-            hashtags = tweet['extended_tweet']['entities']['hashtags']
-            cashtags = tweet['extended_tweet']['entities']['symbols']
-        except KeyError:
-            hashtags = tweet['entities']['hashtags']
-            cashtags = tweet['entities']['symbols']
-
-        tags = ['#' + h['text'] for h in hashtags] + ['$' + c['text'] for c in cashtags]
-        for tag in tags:
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO tweet_tags (id_tweets, tag)
-            VALUES (:id_tweets, :tag)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {
-                'id_tweets': tweet['id'],
-                'tag':       remove_nulls(tag)
-            })
-
-        #################################################
-        # 8. tweet_media
-        #################################################
-        try:
-            media = tweet['extended_tweet']['extended_entities']['media']
-        except KeyError:
-            try:
-                media = tweet['extended_entities']['media']
-            except KeyError:
-                media = []
-
-        for m in media:
-            id_urls = get_id_urls(m['media_url'], connection)
-            sql = sqlalchemy.sql.text('''
-            INSERT INTO tweet_media (id_tweets, id_urls, type)
-            VALUES (:id_tweets, :id_urls, :type)
-            ON CONFLICT DO NOTHING
-            ''')
-            connection.execute(sql, {
-                'id_tweets': tweet['id'],
-                'id_urls':   id_urls,
-                'type':      remove_nulls(m['type'])
-            })
+    NOTE:
+    SQLAlchemy engines cannot be shared across processes,
+    so this function creates its own engine and can be run in a worker process.
+    '''
+
+    engine = create_engine(db, 'load_tweets.py --inputs ' + filename)
+    # NOTE:
+    # most of the time spent in flush_batch is spent waiting on the database,
+    # and psycopg releases the GIL while it waits;
+    # so each full batch is flushed in a background thread while this thread parses the next batch;
+    # at most one flush runs at a time, so the connection is never used by two threads at once
+    with engine.connect() as connection, concurrent.futures.ThreadPoolExecutor(max_workers=1) as flusher:
+        create_staging_tables(connection)
+        batch = Batch()
+        flushing = None
+
+        with zipfile.ZipFile(filename, 'r') as archive:
+            print(datetime.datetime.now(), filename)
+            for subfilename in sorted(archive.namelist(), reverse=True):
+                # NOTE:
+                # orjson parses the raw bytes directly,
+                # so the lines are not decoded to str first;
+                # reading the whole member and splitting it with bytes.split
+                # is also much cheaper than the python-level readline of ZipExtFile;
+                # a lazy parser (cysimdjson) was slower overall than orjson's full parse,
+                # because insert_tweet reads most of the fields that are large enough to matter
+                with archive.open(subfilename) as f:
+                    lines = f.read().split(b'\n')
+                for i, line in enumerate(lines):
+                    if not line:
+                        continue
+                    tweet = orjson.loads(line)
+                    insert_tweet(tweet, batch)
+
+                    if len(batch.tweets) >= batch_size:
+                        if flushing is not None:
+                            flushing.result()
+                        flushing = flusher.submit(flush_batch, connection, batch)
+                        batch = Batch()
+
+                    if i % print_every == 0:
+                        print(datetime.datetime.now(),
+                              filename, subfilename,
+                              'i=', i, 'id=', tweet['id'])
+
+        if flushing is not None:
+            flushing.result()
+        flush_batch(connection, batch)
+    engine.dispose()
 
 
 ################################################################################
@@ -368,26 +694,48 @@ if __name__ == '__main__':
     parser.add_argument('--db', required=True)
     parser.add_argument('--inputs', nargs='+', required=True)
     parser.add_argument('--print_every', type=int, default=1000)
+    parser.add_argument('--batch_size', type=int, default=10000)
+    parser.add_argument('--drop_indexes', action='store_true',
+        help='drop the secondary indexes before loading and rebuild them afterwards; '
+             'only use this when a single load_tweets.py process loads all of the inputs')
     args = parser.parse_args()
 
-    # create database connection
-    engine = sqlalchemy.create_engine(args.db, connect_args={
-        'application_name': 'load_tweets.py',
-    })
-    connection = engine.connect()
-
-    # loop through the input files
-    for filename in sorted(args.inputs, reverse=True):
-        with zipfile.ZipFile(filename, 'r') as archive:
-            print(datetime.datetime.now(), filename)
-            for subfilename in sorted(archive.namelist(), reverse=True):
-                with io.TextIOWrapper(archive.open(subfilename)) as f:
-                    for i, line in enumerate(f):
-                        tweet = json.loads(line)
-                        insert_tweet(connection, tweet)
-
-                        if i % args.print_every == 0:
-                            print(datetime.datetime.now(),
-                                  filename, subfilename,
-                                  'i=', i, 'id=', tweet['id'])
-
+    # NOTE:
+    # the engine is disposed before the worker processes are started,
+    # because they must not inherit its connection
+    if args.drop_indexes:
+        engine = create_engine(args.db)
+        with engine.begin() as connection:
+            index_definitions = drop_indexes(connection)
+        engine.dispose()
+
+    # load each input file in its own worker process;
+    # the files are independent, and ON CONFLICT DO NOTHING makes overlapping rows harmless
+    #
+    # NOTE:
+    # the dropped indexes are rebuilt even if a file fails to load;
+    # their definitions exist only in this process, so they would otherwise be lost
+    try:
+        filenames = sorted(args.inputs, reverse=True)
+        max_workers = min(len(filenames), os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(ingest_file, filename, args.db, args.batch_size, args.print_every)
+                for filename in filenames
+                ]
+            # NOTE:
+            # if a file fails, the files that have not started yet are cancelled;
+            # otherwise leaving the with block would wait for all of them to load before reporting the error,
+            # and a worker whose flush rolled back would load them with url ids cached from the rolled back transaction
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    finally:
+        if args.drop_indexes:
+            with engine.begin() as connection:
+                create_indexes(connection, index_definitions)
+            engine.dispose()